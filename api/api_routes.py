@@ -4,7 +4,7 @@ from flask import Blueprint, request
 from twilio.twiml.messaging_response import MessagingResponse
 
 from models import Playlist
-from spotify import add_tracks_to_playlist, get_or_create_guest_user, get_playlist_key_from_message, get_track_ids_from_message
+from spotify import add_tracks_to_playlist, get_or_create_guest_user, get_playlist_with_owner, get_playlist_key_from_message, get_track_ids_from_message
 from sms import ask_for_playlist_key, invalid_playlist_key_notification, playlist_key_success_notification
 from app import db
 
@@ -31,7 +31,6 @@ def receive_sms():
       # If the key belongs to a playlist
       if playlist:
         guest_user.active_playlist_id = playlist.id # Set the guest user's active playlist to that playlist
-        db.session.add(guest_user)
         db.session.commit()
         playlist_key_success_notification(phone_number=phone_number, playlist=playlist) # Send a message to the user
       else:
@@ -41,7 +40,7 @@ def receive_sms():
     if track_ids:
       # If the guest user has an active playlist
       if guest_user.active_playlist_id:
-        playlist = Playlist.query.filter_by(id=guest_user.active_playlist_id).first() # Get phone number's first playlist
+        playlist = get_playlist_with_owner(guest_user.active_playlist_id) # Get phone number's active playlist
         # If playlist in valid
         if playlist:
           add_tracks_to_playlist(playlist=playlist, track_ids=track_ids, added_by=phone_number) # Add the tracks to the playlist
@@ -3,9 +3,13 @@
 from flask import Flask, redirect
 # from flask_debugtoolbar import DebugToolbarExtension
 from flask_bootstrap import Bootstrap5
+from flask_session import Session
+from sqlalchemy import text
 import os
+import re
 
 # from my_secrets import SECRET_KEY
+from redis_connection import redis_client
 from models import connect_db, db
 from demo.demo_routes import demo
 from auth.auth_routes import auth
@@ -18,17 +22,48 @@ app.register_blueprint(auth, url_prefix="/auth")
 app.register_blueprint(ui, url_prefix="/user")
 app.register_blueprint(api, url_prefix="/api")
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL','postgres:///spotify_sms_playlist').replace("://", "ql://", 1) # PSQL database
+DATABASE_DRIVER = 'postgresql+psycopg2' # SQLAlchemy dialect and driver used for the PSQL database
+app.config['SQLALCHEMY_DATABASE_URI'] = re.sub(r'^postgres(ql)?://', f"{DATABASE_DRIVER}://", os.environ.get('DATABASE_URL','postgres:///spotify_sms_playlist')) # PSQL database
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False # Don't track modifications
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+  'pool_pre_ping': True, # Replace connections the database closed instead of failing the request
+  'pool_size': 5, # Connections kept open per worker
+  'max_overflow': 10, # Extra connections allowed under load
+  'query_cache_size': 1200, # Compiled SQL statements kept for reuse across requests
+}
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'calebshouse') # SECRET_KEY for debug toolbar
 # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False # Disable intercepting redirects
+app.config['SESSION_TYPE'] = 'redis' # Store session data in Redis (required), the cookie only holds the session id
+app.config['SESSION_REDIS'] = redis_client
+app.config['SESSION_PERMANENT'] = False
 
 # toolbar = DebugToolbarExtension(app) # Create debug toolbar object
 bootsrap =Bootstrap5(app) # Create bootstrap object
+Session(app) # Server side sessions
 
 connect_db(app) # Connect database to Flask object 
-db.create_all() # Create all tables
+
+
+# create_all() never changes existing tables, these add columns introduced since they were created.
+# Every statement is safe to run again on each release.
+SCHEMA_UPDATES = [
+  "ALTER TABLE host_users ADD COLUMN IF NOT EXISTS token_expires_at FLOAT",
+  "ALTER TABLE playlists ADD COLUMN IF NOT EXISTS tracks_endpoint TEXT",
+  "UPDATE playlists SET tracks_endpoint = endpoint || '/tracks' WHERE tracks_endpoint IS NULL",
+  "ALTER TABLE playlists ALTER COLUMN tracks_endpoint SET NOT NULL",
+]
+
+
+@app.cli.command('init-db')
+def init_db():
+  """Create all tables and bring existing ones up to date (runs as the release phase with `flask init-db`)"""
+
+  db.create_all()
+
+  for statement in SCHEMA_UPDATES:
+    db.session.execute(text(statement))
+  db.session.commit()
 
 
 @app.route('/')
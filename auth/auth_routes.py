@@ -1,10 +1,19 @@
 """ authorization/login """
 
-from flask import Blueprint, redirect, request, session
-from spotify import AUTHORIZATION_URL, get_auth_tokens, get_or_create_host_user
+import time
+from flask import Blueprint, flash, redirect, render_template, request, session
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+
+from redis_connection import redis_client
+from spotify import AUTHORIZATION_URL
+from tasks import login_host_user, queue
 
 auth = Blueprint("auth", __name__, template_folder="templates")
 
+LOGIN_TIMEOUT = 30 # Seconds to wait for the login job before giving up
+JOB_DONE_STATUSES = (JobStatus.FINISHED, JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED) # Jobs in these states will never change again
+
 
 @auth.route('/', methods=['GET', 'POST'])
 def get_authorization():
@@ -16,17 +25,52 @@ def get_authorization():
 
 @auth.route('/login')
 def login():
-  """Use code from spotify redirect to get authorizion and retrive or ceate a HostUser"""
+  """Use code from spotify redirect to start a background job that retrives or creates a HostUser"""
 
   code = request.args['code'] # Get code returned from authorization
-  auth_data = get_auth_tokens(code) # Get authorization header
-  host_user = get_or_create_host_user(auth_data) # Get or create a HostUser based on their spotify profile data
-  
+  job = queue.enqueue(login_host_user, code, ttl=LOGIN_TIMEOUT) # Get tokens and the HostUser without tying up this worker, dropped if no worker starts it in time
+
+  session['login_job_id'] = job.id # Only this browser can finish the login
+  session['login_started_at'] = time.time()
+  return redirect(f"/auth/status/{job.id}")
+
+
+@auth.route('/status/<string:job_id>')
+def login_status(job_id):
+  """Check on the login job and save the HostUser in the session once it has finished"""
+
+  # Prevent users from finishing someone else's login
+  if session.get('login_job_id') != job_id:
+    return redirect('/auth')
+
+  try:
+    job = Job.fetch(job_id, connection=redis_client)
+  except NoSuchJobError:
+    return redirect('/auth')
+
+  status = job.get_status()
+
+  # if the job is still waiting or running
+  if status not in JOB_DONE_STATUSES:
+    # Show a page that checks again, unless we've waited too long (e.g. no worker is running)
+    if time.time() - session.get('login_started_at', 0) < LOGIN_TIMEOUT:
+      return render_template('login_pending.html')
+
+    job.cancel()
+    flash('Logging in took too long, please try again', 'danger')
+    return redirect('/auth')
+
+  # if the job failed, was stopped or was canceled
+  if status != JobStatus.FINISHED:
+    flash('Something went wrong logging in, please try again', 'danger')
+    return redirect('/auth')
+
+  host_user_id = job.result
+
   # if authentication was not successful
-  print(f"host_user {host_user}")
-  if not host_user:
+  if not host_user_id:
     return redirect('/demo') # redirect to demo page
 
   session.clear() # Remove previous user data from session
-  session['host_user_id'] = host_user.id # Save host_user_id in session
-  return redirect('/user')
\ No newline at end of file
+  session['host_user_id'] = host_user_id # Save host_user_id in session
+  return redirect('/user')
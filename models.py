@@ -1,6 +1,8 @@
 """SQLAlchemy models"""
 
+from functools import cached_property
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import validates
 
 db = SQLAlchemy() # Create database object
 
@@ -41,15 +43,23 @@ class HostUser(GuestUser):
   url = db.Column(db.Text, nullable=False)
   access_token = db.Column(db.Text)
   refresh_token = db.Column(db.Text)
+  token_expires_at = db.Column(db.Float) # Unix time when the access token expires
 
-  playlists = db.relationship('Playlist', backref='owner', cascade='all, delete-orphan')
+  playlists = db.relationship('Playlist', back_populates='owner', cascade='all, delete-orphan')
 
-  @property
+  @cached_property
   def auth_header(self):
     """Create the authorization header from the acccess token. Return as a python dictionary"""
 
     return {'Authorization': f'Bearer {self.access_token}'}
 
+  @validates('access_token')
+  def validate_access_token(self, key, access_token):
+    """Forget the cached auth_header whenever the access token changes"""
+
+    self.__dict__.pop('auth_header', None)
+    return access_token
+
   __mapper_args__ = {"polymorphic_identity": "host_users"}
 
 
@@ -63,9 +73,11 @@ class Playlist(db.Model):
   key = db.Column(db.Text, unique=True, nullable=False)
   url = db.Column(db.Text, nullable=False)
   endpoint = db.Column(db.Text, nullable=False)
+  tracks_endpoint = db.Column(db.Text, nullable=False) # Endpoint for adding tracks, built once when the playlist is created
 
   owner_id = db.Column(db.Text, db.ForeignKey('host_users.id'), nullable=False)
-  
+  owner = db.relationship('HostUser', back_populates='playlists') # get_playlist_with_owner joins it in when it's needed
+
   tracks = db.relationship(
     'Track',
     secondary="playlist_tracks",
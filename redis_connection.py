@@ -0,0 +1,11 @@
+"""Redis connection shared by server side sessions and the background job queue
+
+Redis is required: Flask-Session loads the session from Redis on every request that uses
+it and does not handle connection errors, so those requests fail while Redis is down"""
+
+import os
+import redis
+
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+
+redis_client = redis.Redis.from_url(REDIS_URL) # Connections come from the client's connection pool
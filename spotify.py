@@ -1,11 +1,17 @@
 """Spotify API Requests"""
 
 import os
-import json
+import orjson
 import requests
 import re
 from urllib.parse import urlencode
 import base64
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from sqlalchemy.orm import joinedload, raiseload
+from urllib3.util.retry import Retry
 
 from models import GuestUser, HostUser, Playlist, PlaylistTrack, Track, db
 from sms import key_instructions_notification, playlist_key_success_notification
@@ -24,7 +30,27 @@ SPOTIFY_AUTH_URL= SPOTIFY_AUTH_BASE_URL + '/authorize/'
 SPOTIFY_TOKEN_URL = SPOTIFY_AUTH_BASE_URL + '/api/token'
 
 SPOTIFY_API_URL = 'https://api.spotify.com/v1'
+USER_PROFILE_ENDPOINT = SPOTIFY_API_URL + '/me'
 
+TOKEN_EXPIRY_MARGIN = 30 # Seconds before expiry when an access token is refreshed
+
+
+
+# Pooled session so calls to Spotify reuse the same TCP/TLS connection
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+  pool_connections=10,
+  pool_maxsize=20,
+  max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 502, 503], raise_on_status=False, respect_retry_after_header=False) # Back off briefly, never sleep for the full Retry-After inside a request
+))
+SESSION.headers.update({'Accept-Encoding': 'gzip'}) # Ask Spotify for gzipped responses
+
+# Thread pool for sending several Spotify requests at once, small enough to avoid rate limiting (429)
+MAX_CONCURRENT_REQUESTS = 5
+SPOTIFY_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+
+MAX_TRACKS_PER_REQUEST = 100 # Limit on uris when adding tracks to a playlist
+MAX_TRACKS_PER_LOOKUP = 50 # Limit on ids when getting several tracks
 
 SCOPE = 'user-read-email playlist-modify-public playlist-modify-private' # Scope of authorization
 
@@ -60,12 +86,12 @@ def get_auth_tokens(code):
   }
 
   # Pass authorization code and client secret key to the Spotify Accounts Service
-  auth_response = requests.post(SPOTIFY_TOKEN_URL, headers=SPOTIFY_CLIENT_HEADER , data=data)
+  auth_response = SESSION.post(SPOTIFY_TOKEN_URL, headers=SPOTIFY_CLIENT_HEADER , data=data)
 
   # Tokens returned 
   # if spotify gave us a sccessful status code
   if auth_response.status_code == 200:
-    return json.loads(auth_response.text) # return the response, .json() to convert to a python dictionary
+    return orjson.loads(auth_response.content) # return the response as a python dictionary, parsed straight from the bytes
   
   return None
 
@@ -78,35 +104,103 @@ def refresh_access_token(user):
     "refresh_token": user.refresh_token
   }
 
-  auth_response = requests.post(SPOTIFY_TOKEN_URL, headers=SPOTIFY_CLIENT_HEADER, data=data)
-  auth_data = json.loads(auth_response.text)
+  auth_response = SESSION.post(SPOTIFY_TOKEN_URL, headers=SPOTIFY_CLIENT_HEADER, data=data)
+  auth_data = orjson.loads(auth_response.content)
 
   user.access_token = auth_data["access_token"]
+  user.token_expires_at = time.time() + auth_data["expires_in"]
 
-  db.session.add(user)
   db.session.commit()
   return user
 
 
-def make_authorized_api_call(host_user, endpoint, method='POST', data=None, params=None):
+def refresh_expiring_access_token(host_user):
+  """Refresh the access token before it expires instead of waiting for a 401
+
+  Users without a known expiry time fall back to the 401 check in make_authorized_api_call"""
+
+  if host_user.token_expires_at and time.time() >= host_user.token_expires_at - TOKEN_EXPIRY_MARGIN:
+    refresh_access_token(host_user)
+
+
+def send_api_request(endpoint, headers, method='POST', data=None, params=None, json_body=None):
+  """Send a request to the Spotify API through the pooled session
+
+  json_body is encoded with orjson and sent as the request body with a JSON content type"""
+
+  if json_body is not None:
+    data = orjson.dumps(json_body)
+    headers = {**headers, "Content-Type": "application/json"}
+
+  return SESSION.request(method, endpoint, headers=headers, data=data, params=params)
+
+
+def unpack_response(response):
+  """Return the response as a python dictionary, or None if the request failed"""
+
+  if response.status_code < 400:
+    return orjson.loads(response.content) # Unpack response
+  else:
+    return None
+
+
+def make_authorized_api_call(host_user, endpoint, method='POST', data=None, params=None, json_body=None):
   """Make an authorized api call with protection against expired access tokens.
 
   Return the responce in a python dictionary"""
-  if method == 'POST':
-    request_method = requests.post
-  elif method == 'GET':
-    request_method = requests.get
 
-  request = request_method(endpoint, headers=host_user.auth_header, data=data,params=params)
-  # Check for expired access token (error code 401)
+  refresh_expiring_access_token(host_user)
+  request = send_api_request(endpoint, headers=host_user.auth_header, method=method, data=data, params=params, json_body=json_body)
+  # Check for expired access token (error code 401), a safety net for tokens that expired early
   if request.status_code == 401:
     refresh_access_token(host_user) #refresh the owner's access_token
-    request = request_method(endpoint, headers=host_user.auth_header, data=data,params=params) # make the request again
+    request = send_api_request(endpoint, headers=host_user.auth_header, method=method, data=data, params=params, json_body=json_body) # make the request again
 
-  if request.status_code < 400:
-    return json.loads(request.text) # Unpack response
-  else:
-    return None
+  return unpack_response(request)
+
+
+def make_authorized_api_calls(host_user, calls):
+  """Make several authorized api calls concurrently.
+
+  calls is a list of dictionaries with the keyword arguments of make_authorized_api_call
+  (endpoint, method, data, params, json_body). At most MAX_CONCURRENT_REQUESTS are sent at once.
+  Expired access tokens are refreshed on this thread so the database is never touched
+  from the thread pool.
+
+  Return a list of responses as python dictionaries (None for failed requests) in the same order as calls"""
+
+  refresh_expiring_access_token(host_user)
+  auth_header = host_user.auth_header # Read on this thread, the ORM object is not shared with the pool
+
+  def send(call):
+    return send_api_request(headers=auth_header, **call)
+
+  responses = list(SPOTIFY_EXECUTOR.map(send, calls))
+
+  # Check for expired access token (error code 401)
+  expired = [i for i, response in enumerate(responses) if response.status_code == 401]
+  if expired:
+    refresh_access_token(host_user) # refresh the owner's access_token
+    auth_header = host_user.auth_header
+    retried = SPOTIFY_EXECUTOR.map(send, [calls[i] for i in expired]) # make the expired requests again
+    for i, response in zip(expired, retried):
+      responses[i] = response
+
+  return [unpack_response(response) for response in responses]
+
+
+def get_user_profile(access_token):
+  """Get the Spotify profile of the user with the access_token
+
+  Return the profile as a python dictionary, or None if the request was not successful"""
+
+  auth_header = {"Authorization": f"Bearer {access_token}"}
+  profile_response = send_api_request(USER_PROFILE_ENDPOINT, headers=auth_header, method='GET')
+  profile_data = unpack_response(profile_response)
+
+  # None if we got 403 "forbidden" (if the spotify account is not added to our app, required because the spotify app is in development mode)
+  # or any other unsuccessful status code
+  return profile_data
 
 
 # -------------------------- DATABASE ---------------------------
@@ -122,50 +216,57 @@ def get_or_create_host_user(auth_data):
 
   access_token = auth_data["access_token"]
   refresh_token = auth_data["refresh_token"]
-  auth_header = {"Authorization": f"Bearer {access_token}"}
+  token_expires_at = time.time() + auth_data["expires_in"]
+  profile_data = get_user_profile(access_token)
 
+  # If the profile could not be retrieved
+  if not profile_data:
+    return None # Don't return a host_user.
 
-  USER_PROFILE_ENDPOINT = SPOTIFY_API_URL + '/me'
-  profile_response = requests.get(USER_PROFILE_ENDPOINT, headers=auth_header) # .json() to unpack
+  # Get data from response
+  display_name = profile_data['display_name']
+  email = profile_data['email']
+  url = profile_data['external_urls']['spotify']
+  id = profile_data['id'] # Use same id as spotify
 
-  # If we got 403 "forbidden" (if the spotify account is not added to our app, required because the spotify app is in development mode) 
-  if profile_response.status_code == 403: 
-    return None # Don't return a host_user.
-  
-  # If request was successul (200)
-  elif profile_response.status_code == 200: 
-    profile_data = profile_response.json()
-
-    # Get data from response
-    display_name = profile_data['display_name']
-    email = profile_data['email']
-    url = profile_data['external_urls']['spotify']
-    id = profile_data['id'] # Use same id as spotify
-
-    guest_user = GuestUser.query.filter_by(id=id).first() # Check if there GuestUser in the database 
-    
+  # Check if the user is already in the database, loading HostUser columns in the same query
+  user = GuestUser.query.with_polymorphic(HostUser).filter_by(id=id).first()
+
+  # If the HostUser already exits update the access token and refresh token 
+  if isinstance(user, HostUser):
+    host_user = user
+    host_user.access_token = access_token # Update access_token
+    host_user.refresh_token = refresh_token # Update access_token
+    host_user.token_expires_at = token_expires_at # Update when the access_token expires
+
+  # If the user is not in the database as a HostUser
+  else:
     # If there is already guest user in the database with the same id
-    if guest_user:
-      db.session.delete(guest_user) # Delete the guest user from the database so we can create a host user with the same id
-      db.session.commit() 
-    
-    host_user = HostUser.query.filter_by(id=id).first() # Check if the HostUser is already in the database
+    if user:
+      db.session.delete(user) # Delete the guest user from the database so we can create a host user with the same id
+      db.session.flush() # Delete before inserting the HostUser with the same id
+
+    # Create HostUser object
+    host_user = HostUser(display_name=display_name, email=email, url=url, id=id, access_token=access_token, refresh_token=refresh_token, token_expires_at=token_expires_at)
+    db.session.add(host_user) # Add HostUser to database
+
+  db.session.commit() 
 
-    # If the user is not in the database
-    if not host_user:
-      # Create HostUser object.query.filter_by(id=id).first()
-      host_user = HostUser(display_name=display_name, email=email, url=url, id=id, access_token=access_token, refresh_token=refresh_token)
-      db.session.add(host_user) # Add HostUser to database
-      db.session.commit() 
+  return host_user # return the HostUser object
 
-    # If the HostUser already exits update the access token and refresh token 
-    else:
-      host_user.access_token = access_token # Update access_token
-      host_user.refresh_token = refresh_token # Update access_token
-      db.session.add(host_user) # Update HostUser
-      db.session.commit() 
 
-    return host_user # return the HostUser object
+def get_playlist_with_owner(playlist_id):
+  """Get a playlist with its owner loaded, ready for add_tracks_to_playlist
+
+  In debug or testing any other lazy load from the playlist raises an error, so extra
+  queries sneaking into the Spotify requests show up instead of running silently"""
+
+  query = Playlist.query.options(joinedload(Playlist.owner))
+
+  if current_app.debug or current_app.testing:
+    query = query.options(raiseload('*'))
+
+  return query.filter_by(id=playlist_id).first()
 
 
 def get_or_create_guest_user(phone_number):
@@ -187,27 +288,26 @@ def create_playlist(host_user, title, key):
   """Create a playlist on the users account"""
 
   # Data for created playlist
-  data = json.dumps({
+  playlist_body = {
     "name": title,
     "description": f"Text #{key} to {MY_TWILIO_NUMBER} to start adding songs via text",
     "public": False, # Collaborative playlists cannot be public
     "collaborative": True 
-  })
+  }
 
   create_playlist_endpoint = SPOTIFY_API_URL + f"/users/{host_user.id}/playlists"
 
-  playlist_data = make_authorized_api_call(host_user=host_user, endpoint=create_playlist_endpoint, data=data)
+  playlist_data = make_authorized_api_call(host_user=host_user, endpoint=create_playlist_endpoint, json_body=playlist_body)
 
   id = playlist_data['id'] # Use the same id as spotify
   url = playlist_data['external_urls']['spotify'] # Used for links in user interface
   playlist_endpoint = playlist_data['href'] # Used for adding tracks
   owner_id = playlist_data['owner']['id'] # Use the same owner id as spotify
 
-  new_playlist = Playlist(id=id, title=title, key=key, url=url, endpoint=playlist_endpoint, owner_id=owner_id)
+  new_playlist = Playlist(id=id, title=title, key=key, url=url, endpoint=playlist_endpoint, tracks_endpoint=playlist_endpoint + "/tracks", owner_id=owner_id)
   db.session.add(new_playlist)
 
   host_user.active_playlist_id = new_playlist.id
-  db.session.add(host_user)
   db.session.commit() # commit to database
 
   playlist_key_success_notification(phone_number=host_user.phone_number, playlist=new_playlist) # Send a message to the user
@@ -216,45 +316,48 @@ def create_playlist(host_user, title, key):
   return new_playlist
 
 
-def get_or_create_track(host_user, track_id):
-  """Make an API call to get rack data"""
+def get_or_create_tracks(host_user, track_ids):
+  """Get tracks from the database, fetching the missing ones from Spotify in concurrent batches
 
-  track = Track.query.filter_by(id=track_id).first() # Check if the Track is already in the Database
-  
-  if not track:
-    get_track_endpoint = SPOTIFY_API_URL + '/tracks/' + track_id
-    track_data = make_authorized_api_call(
-      host_user=host_user, 
-      method='GET', 
-      endpoint=get_track_endpoint
-    )
-    # if the request was successful
-    if track_data:
-
-      id = track_data['id'] # Use same id as spotify
-      name = track_data['name']
-      artist = track_data['artists'][0]['name']
-      track = Track(id=id, name=name, artist=artist)
-      db.session.add(track)
-      db.session.commit()
-    
-  return track
+  Return a list of Track objects in the same order as track_ids, skipping tracks that could not be fetched"""
+
+  tracks = {track.id: track for track in Track.query.filter(Track.id.in_(track_ids)).all()} # Tracks already in the Database
+  missing_track_ids = [track_id for track_id in track_ids if track_id not in tracks]
+
+  if missing_track_ids:
+    # Spotify looks up at most 50 tracks per request, split the ids into batches
+    batches = [missing_track_ids[i:i + MAX_TRACKS_PER_LOOKUP] for i in range(0, len(missing_track_ids), MAX_TRACKS_PER_LOOKUP)]
+    responses = make_authorized_api_calls(host_user=host_user, calls=[
+      {"method": 'GET', "endpoint": SPOTIFY_API_URL + '/tracks', "params": {"ids": ','.join(batch)}} for batch in batches
+    ])
+
+    for batch, tracks_data in zip(batches, responses):
+      # if the request was not successful
+      if not tracks_data:
+        continue
+
+      for track_id, track_data in zip(batch, tracks_data['tracks']):
+        # Spotify returns null for ids it doesn't know
+        if track_data:
+          name = track_data['name']
+          artist = track_data['artists'][0]['name']
+          track = Track(id=track_id, name=name, artist=artist)
+          db.session.add(track)
+          tracks[track_id] = track
+
+    db.session.commit()
+
+  return [tracks[track_id] for track_id in track_ids if track_id in tracks]
 
 # -------------------------- OTHER REQUESTS ---------------------------
 
-def get_track_ids_from_message(message):
-  """Returns a list of Spotify track URLs in a string"""
+TRACK_URL_REGEX = re.compile(r'https://open\.spotify\.com/track/([A-Za-z0-9]{22})') # Regex for finding track urls, captures the track id
 
-  track_ids = [] # List of track_ids to return
 
-  urls = re.findall('https:\/\/open.spotify.com\/track\/+[^? ]*', message) # Regex for finding track urls
-  
-  # Iterate over found urls
-  for url in urls:
-    track_id = url.replace('https://open.spotify.com/track/', '') # replace the begining to get the track id
-    track_ids.append(track_id) # Append track_id to our list to return
+def get_track_ids_from_message(message):
+  """Returns a list of Spotify track ids from the track URLs in a string"""
 
-  return track_ids
+  return TRACK_URL_REGEX.findall(message)
 
 
 def get_playlist_key_from_message(message):
@@ -270,30 +373,47 @@ def get_playlist_key_from_message(message):
 
 
 def add_tracks_to_playlist(playlist, track_ids, added_by=None):
-  """Make a post request to add the track_ids to the Spotify playlist"""
+  """Make post requests to add the track_ids to the Spotify playlist
 
-  add_tracks_endpoint = playlist.endpoint + "/tracks"
-  
-  # For all track_ids after the first (track_ids[1:]) add them with a comma seperator
-  for track_id in track_ids:
-    uris_string = 'spotify:track:' + track_id # Format the first track track_ids[0]
+  Tracks are sent in batches of MAX_TRACKS_PER_REQUEST, one batch after another so Spotify
+  adds them in the order they were texted. Return a list of the PlaylistTrack objects that were added"""
+
+  track_ids = list(dict.fromkeys(track_ids)) # Drop repeated links in the message
 
+  # Tracks texted in an earlier message are already in the playlist, only send and store new ones
+  stored_track_ids = {track_id for (track_id,) in db.session.query(PlaylistTrack.track_id).filter(
+    PlaylistTrack.playlist_id == playlist.id,
+    PlaylistTrack.track_id.in_(track_ids)
+  )}
+  track_ids = [track_id for track_id in track_ids if track_id not in stored_track_ids]
+
+  # If there are no new tracks
+  if not track_ids:
+    return []
+
+  host_user = playlist.owner
+
+  # Spotify accepts at most 100 uris per request, split the tracks into batches
+  batches = [track_ids[i:i + MAX_TRACKS_PER_REQUEST] for i in range(0, len(track_ids), MAX_TRACKS_PER_REQUEST)]
+
+  added_track_ids = [] # Tracks whose request was successful
+
+  for batch in batches:
     # Make the post request to add the tracks to the playlist
     response = make_authorized_api_call(
-      host_user=playlist.owner, 
-      endpoint=add_tracks_endpoint, 
-      params={"uris": uris_string}  # Pass the track_ids to spotify in the query string with the key "uris"
+      host_user=host_user,
+      endpoint=playlist.tracks_endpoint,
+      json_body={"uris": [f"spotify:track:{track_id}" for track_id in batch]} # Pass the uris to spotify in the request body
     )
     # If the request was successful
     if response:
-      track = get_or_create_track(host_user=playlist.owner, track_id=track_id)
-      new_playlist_track = PlaylistTrack(
-        playlist_id=playlist.id, 
-        track_id=track.id,
-        added_by=added_by
-      )
-      db.session.add(new_playlist_track)
-      db.session.commit()
-      return new_playlist_track
-  
-  return None
\ No newline at end of file
+      added_track_ids.extend(batch)
+
+  new_playlist_tracks = [
+    PlaylistTrack(playlist_id=playlist.id, track_id=track.id, added_by=added_by)
+    for track in get_or_create_tracks(host_user=host_user, track_ids=added_track_ids)
+  ]
+  db.session.add_all(new_playlist_tracks)
+  db.session.commit()
+
+  return new_playlist_tracks
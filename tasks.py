@@ -0,0 +1,24 @@
+"""Background jobs run by the RQ worker"""
+
+from rq import Queue
+
+from redis_connection import redis_client
+from spotify import get_auth_tokens, get_or_create_host_user
+
+queue = Queue(connection=redis_client) # Jobs are run by worker.py (see Procfile)
+
+def login_host_user(code):
+  """Exchange the authorization code for tokens and get or create the HostUser
+
+  Return the HostUser's id, or None if authentication was not successful"""
+
+  from app import app # Imported here because app imports the blueprint that enqueues this job, worker.py preloads it
+
+  with app.app_context():
+    auth_data = get_auth_tokens(code) # Get authorization header
+    host_user = get_or_create_host_user(auth_data) # Get or create a HostUser based on their spotify profile data
+
+    if host_user:
+      return host_user.id
+
+  return None
@@ -0,0 +1,5 @@
+"""Tests
+
+The tests need a local PostgreSQL database named spotify_sms_playlist_test and a Redis
+server at REDIS_URL (default redis://localhost:6379), because sessions are stored in Redis.
+Run them from the project root with `python -m unittest`."""
@@ -1,7 +1,20 @@
+import time
 from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from rq.job import JobStatus
 from app import app
 from flask import session
 
+test_job_id = 'test-login-job'
+
+def make_job(status, result=None):
+  """Make a stand in for an RQ job so the tests don't need a worker"""
+
+  job = MagicMock(id=test_job_id, result=result)
+  job.get_status.return_value = status
+  return job
+
 class AuthTests(TestCase):
 
   def setUp(self):
@@ -10,6 +23,13 @@ class AuthTests(TestCase):
     self.client = app.test_client()
     app.config['TESTING'] = True
 
+  def start_login(self, started_at=None):
+    """Put a login job in the session as if /auth/login had just run"""
+
+    with self.client.session_transaction() as sess:
+      sess['login_job_id'] = test_job_id
+      sess['login_started_at'] = started_at or time.time()
+
   def test_auth(self):
     """Verify /auth redirects to spotify's authentication page"""
     
@@ -21,8 +41,84 @@ class AuthTests(TestCase):
   def test_login_user_without_access(self):
     """Verify redirect from Spotify is handled correctly when user is not added to the access list"""
 
-    # Fake redirect from spotify for an account without access
-    response = self.client.get('/auth/login?code=AQAb_vZ6h6z7NTldkjT706Sjv3t5Is4a8j2rsSuIQ5zO2acUhIbDKZi4Yp4cYEUd1QG_3auWW8ytfCGxu6tRo3c8XLWhboGoib39_gmJQdzadnO099OhzF4kWazGWFtYS0OxxohLxyilA2PhYVVDDV2iazI52zf4BSiglyj4i9vPU4TzCSTRQAfHdA5vgXgdmXY0lNV7OhoB9mbIGqwNhmZYv_jzqXIN9GlhW1CRPAq6il1AVWHhf6eoJfNgybSox1mz9YAo')
+    jobs = []
+
+    def run_now(func, *args, **kwargs):
+      """Run the login job right away instead of queueing it in Redis"""
+
+      jobs.append(make_job(JobStatus.FINISHED, result=func(*args)))
+      return jobs[-1]
+
+    with patch('auth.auth_routes.queue.enqueue', side_effect=run_now), patch('auth.auth_routes.Job') as Job:
+      Job.fetch.side_effect = lambda job_id, connection: jobs[-1]
+
+      # Fake redirect from spotify for an account without access
+      response = self.client.get('/auth/login?code=AQAb_vZ6h6z7NTldkjT706Sjv3t5Is4a8j2rsSuIQ5zO2acUhIbDKZi4Yp4cYEUd1QG_3auWW8ytfCGxu6tRo3c8XLWhboGoib39_gmJQdzadnO099OhzF4kWazGWFtYS0OxxohLxyilA2PhYVVDDV2iazI52zf4BSiglyj4i9vPU4TzCSTRQAfHdA5vgXgdmXY0lNV7OhoB9mbIGqwNhmZYv_jzqXIN9GlhW1CRPAq6il1AVWHhf6eoJfNgybSox1mz9YAo')
+
+      self.assertEqual(response.status_code, 302)
+      self.assertEqual(response.location, f"/auth/status/{test_job_id}")
+
+      response = self.client.get(response.location)
+
+      self.assertEqual(response.status_code, 302)
+      self.assertEqual(response.location, '/demo')
+
+  def test_login_status_from_another_session(self):
+    """Verify a login job can't be finished by a session that didn't start it"""
+
+    response = self.client.get('/auth/status/not-my-job')
+
+    self.assertEqual(response.status_code, 302)
+    self.assertEqual(response.location, '/auth')
+
+  @patch('auth.auth_routes.Job')
+  def test_login_status_finished(self, Job):
+    """Verify a finished login job saves the host user in the session"""
+
+    Job.fetch.return_value = make_job(JobStatus.FINISHED, result='1245079776')
+    self.start_login()
+
+    with self.client:
+      response = self.client.get(f"/auth/status/{test_job_id}")
+
+      self.assertEqual(response.status_code, 302)
+      self.assertEqual(response.location, '/user')
+      self.assertEqual(session['host_user_id'], '1245079776')
+
+  @patch('auth.auth_routes.Job')
+  def test_login_status_failed(self, Job):
+    """Verify a failed login job sends the user back to log in again"""
+
+    Job.fetch.return_value = make_job(JobStatus.FAILED)
+    self.start_login()
+
+    response = self.client.get(f"/auth/status/{test_job_id}")
+
+    self.assertEqual(response.status_code, 302)
+    self.assertEqual(response.location, '/auth')
+
+  @patch('auth.auth_routes.Job')
+  def test_login_status_pending(self, Job):
+    """Verify a running login job shows the page that checks again"""
+
+    Job.fetch.return_value = make_job(JobStatus.STARTED)
+    self.start_login()
+
+    response = self.client.get(f"/auth/status/{test_job_id}")
+
+    self.assertEqual(response.status_code, 200)
+    self.assertIn(b'Logging in', response.data)
+
+  @patch('auth.auth_routes.Job')
+  def test_login_status_timed_out(self, Job):
+    """Verify a login job that never finishes is canceled instead of checked forever"""
+
+    job = make_job(JobStatus.QUEUED)
+    Job.fetch.return_value = job
+    self.start_login(started_at=time.time() - 60)
+
+    response = self.client.get(f"/auth/status/{test_job_id}")
 
     self.assertEqual(response.status_code, 302)
-    self.assertEqual(response.location, '/demo')
\ No newline at end of file
+    self.assertEqual(response.location, '/auth')
+    job.cancel.assert_called_once()
@@ -0,0 +1,164 @@
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy.exc import InvalidRequestError
+from app import app
+from models import GuestUser, HostUser, Playlist, PlaylistTrack, Track, db
+from spotify import add_tracks_to_playlist, get_or_create_host_user, get_playlist_with_owner
+
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotify_sms_playlist_test' # Test database
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+
+db.create_all()
+
+test_host_user_id = 'spotify_test_host_user'
+test_playlist_id = 'spotify_test_playlist'
+test_track_ids = ['spotifytesttrack000001', 'spotifytesttrack000002']
+test_guest_user_id = 'spotify_test_guest_user'
+test_new_user_id = 'spotify_test_new_user'
+test_auth_data = {'access_token': 'new access token', 'refresh_token': 'new refresh token', 'expires_in': 3600}
+
+def make_profile(id):
+  """Make a Spotify profile like the one returned by /me"""
+
+  return {
+    'id': id,
+    'display_name': id,
+    'email': f"{id}@example.com",
+    'external_urls': {'spotify': f"https://open.spotify.com/user/{id}"}
+  }
+
+class SpotifyTestCase(TestCase):
+  """A host user who owns a playlist, plus a Track for each id in track_ids"""
+
+  track_ids = []
+
+  def setUp(self):
+    """Before every test"""
+
+    host_user = HostUser(id=test_host_user_id,
+      display_name='test host user',
+      email='spotify_test_host_user@example.com',
+      url=f"https://open.spotify.com/user/{test_host_user_id}")
+
+    playlist = Playlist(id=test_playlist_id,
+      title='test playlist',
+      key='spotifytest',
+      url=f"https://open.spotify.com/playlist/{test_playlist_id}",
+      endpoint=f"https://api.spotify.com/v1/playlists/{test_playlist_id}",
+      tracks_endpoint=f"https://api.spotify.com/v1/playlists/{test_playlist_id}/tracks",
+      owner_id=test_host_user_id)
+
+    tracks = [Track(id=track_id, name='test track', artist='test artist') for track_id in self.track_ids]
+
+    db.session.add_all([host_user, playlist, *tracks])
+    db.session.commit()
+    db.session.expunge_all() # Load everything fresh from the database in each test
+
+  def tearDown(self):
+    """Clean up test database"""
+
+    db.session.rollback()
+    PlaylistTrack.query.filter_by(playlist_id=test_playlist_id).delete()
+    Track.query.filter(Track.id.in_(self.track_ids)).delete()
+    db.session.delete(HostUser.query.get(test_host_user_id)) # Deletes the playlist too
+    db.session.commit()
+
+
+class GetPlaylistWithOwnerTests(SpotifyTestCase):
+
+  def test_owner_is_loaded(self):
+    """Test the playlist's owner is loaded with the playlist"""
+
+    with app.app_context():
+      playlist = get_playlist_with_owner(test_playlist_id)
+
+      self.assertEqual(playlist.owner.id, test_host_user_id)
+
+  def test_lazy_load_raises_when_testing(self):
+    """Test lazy loading another relationship from the playlist raises an error"""
+
+    with app.app_context():
+      playlist = get_playlist_with_owner(test_playlist_id)
+
+      with self.assertRaises(InvalidRequestError):
+        playlist.tracks
+
+
+class AddTracksToPlaylistTests(SpotifyTestCase):
+
+  track_ids = test_track_ids
+
+  @patch('spotify.make_authorized_api_call', return_value={'snapshot_id': 'test'})
+  def test_track_repeated_from_earlier_message(self, make_authorized_api_call):
+    """Test a track texted again in a later message isn't sent to Spotify or stored again"""
+
+    with app.app_context():
+      playlist = get_playlist_with_owner(test_playlist_id)
+      add_tracks_to_playlist(playlist=playlist, track_ids=test_track_ids[:1], added_by='+12345678')
+
+      playlist = get_playlist_with_owner(test_playlist_id) # The next text message is a new request
+      new_playlist_tracks = add_tracks_to_playlist(playlist=playlist, track_ids=test_track_ids, added_by='+12345678')
+
+      self.assertEqual([playlist_track.track_id for playlist_track in new_playlist_tracks], test_track_ids[1:])
+      self.assertEqual(make_authorized_api_call.call_count, 2) # One request per message
+      self.assertEqual(make_authorized_api_call.call_args.kwargs['json_body'], {"uris": [f"spotify:track:{test_track_ids[1]}"]})
+      self.assertEqual(PlaylistTrack.query.filter_by(playlist_id=test_playlist_id).count(), 2)
+
+
+class GetOrCreateHostUserTests(SpotifyTestCase):
+
+  def tearDown(self):
+    """Clean up test database"""
+
+    db.session.rollback()
+    for user in GuestUser.query.filter(GuestUser.id.in_([test_guest_user_id, test_new_user_id])).all():
+      db.session.delete(user)
+    db.session.commit()
+
+    super().tearDown()
+
+  @patch('spotify.get_user_profile', return_value=make_profile(test_host_user_id))
+  def test_existing_host_user(self, get_user_profile):
+    """Test a host user logging in again keeps their playlists and gets new tokens"""
+
+    host_user = get_or_create_host_user(test_auth_data)
+
+    self.assertEqual(host_user.id, test_host_user_id)
+    self.assertEqual(host_user.access_token, 'new access token')
+    self.assertEqual(host_user.refresh_token, 'new refresh token')
+    self.assertGreater(host_user.token_expires_at, time.time())
+    self.assertIsNotNone(Playlist.query.get(test_playlist_id))
+
+  @patch('spotify.get_user_profile', return_value=make_profile(test_guest_user_id))
+  def test_guest_user_replaced(self, get_user_profile):
+    """Test a guest user with the same id is replaced by a host user"""
+
+    db.session.add(GuestUser(id=test_guest_user_id, phone_number='+15555550100'))
+    db.session.commit()
+    db.session.expunge_all()
+
+    host_user = get_or_create_host_user(test_auth_data)
+
+    self.assertEqual(host_user.id, test_guest_user_id)
+    db.session.expunge_all() # Check what was saved in the database
+    self.assertIsInstance(GuestUser.query.get(test_guest_user_id), HostUser)
+    self.assertEqual(GuestUser.query.filter_by(id=test_guest_user_id).count(), 1)
+
+  @patch('spotify.get_user_profile', return_value=make_profile(test_new_user_id))
+  def test_new_user_created(self, get_user_profile):
+    """Test a new host user is created for someone who hasn't logged in before"""
+
+    host_user = get_or_create_host_user(test_auth_data)
+
+    self.assertEqual(host_user.id, test_new_user_id)
+    db.session.expunge_all() # Check what was saved in the database
+    self.assertEqual(HostUser.query.get(test_new_user_id).email, f"{test_new_user_id}@example.com")
+
+  @patch('spotify.get_user_profile', return_value=None)
+  def test_profile_not_available(self, get_user_profile):
+    """Test no host user is returned when the Spotify profile can't be retrieved"""
+
+    self.assertIsNone(get_or_create_host_user(test_auth_data))
@@ -1,6 +1,7 @@
 """ User interface """
 
 from flask import Blueprint, flash, redirect, render_template, session
+from sqlalchemy.orm import selectinload
 
 from .ui_forms import CreatePlaylistForm, PhoneForm
 from models import GuestUser, HostUser, Playlist
@@ -55,7 +56,6 @@ def get_phone_number():
       db.session.commit()
 
     host_user.phone_number = form.phone.data # Set host user's phone number
-    db.session.add(host_user)
     db.session.commit()
     flash('Phone Number Updated', 'success')
     return redirect('/user')
@@ -92,7 +92,6 @@ def delete_playlist(id):
     guest_users = GuestUser.query.filter_by(active_playlist_id=id).all()
     for guest_user in guest_users:
       guest_user.active_playlist_id = None # Set thier active playlist id to None
-      db.session.add(guest_user)
     
     db.session.delete(playlist) # delete the playlist (This will not delete the playlist on spotify)
     db.session.commit()
@@ -115,7 +114,6 @@ def activate_playlist(id):
 
   if playlist:
     host_user.active_playlist_id = playlist.id
-    db.session.add(host_user) 
     db.session.commit()
     playlist_key_success_notification(phone_number=host_user.phone_number, playlist=playlist) # Send a message to the user
     flash('Playlist activated, Spotify links recieved from you will be added here', 'success')
@@ -128,7 +126,7 @@ def activate_playlist(id):
 def show_all_playlists():
   """Show all of users playlists and a """
 
-  host_user = get_host_user_from_session()
+  host_user = get_host_user_from_session(load_playlists=True)
 
   # Prevent users from jumping ahead without first authorizing
   if not host_user:
@@ -146,13 +144,20 @@ def show_all_playlists():
 
   return render_template('all_playlists.html', host_user=host_user, form=form)
 
-def get_host_user_from_session():
-  """Prevent users from jumping ahead to /user without first authorizing"""
+def get_host_user_from_session(load_playlists=False):
+  """Prevent users from jumping ahead to /user without first authorizing
+
+  Set load_playlists to load the host user's playlists up front for pages that list them"""
 
   if 'host_user_id' not in session:
     return None
 
-  return HostUser.query.filter_by(id=session['host_user_id']).first() # Get host_user using host_user_id in session
+  query = HostUser.query
+
+  if load_playlists:
+    query = query.options(selectinload(HostUser.playlists))
+
+  return query.filter_by(id=session['host_user_id']).first() # Get host_user using host_user_id in session
 
 @ui.route('/tutorial', methods = ['GET', 'POST'])
 def tutorial():
@@ -0,0 +1,13 @@
+"""RQ worker for the background jobs in tasks.py
+
+Run with `python worker.py`. The Flask app is imported here once, so the work horse forked
+for each job already has it instead of importing it on every login"""
+
+from rq import Worker
+
+from app import app # Preload the app for the jobs
+from redis_connection import redis_client
+from tasks import queue
+
+if __name__ == '__main__':
+  Worker([queue], connection=redis_client).work()